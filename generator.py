@@ -33,6 +33,15 @@ __license__ = "MIT"
 import argparse
 import os.path
 import os
+import sys
+import glob
+import datetime
+import time
+import mmap
+import hashlib
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
 import pandas
 import numpy as np
@@ -91,6 +100,263 @@ def xml2text(elem, encoding="utf-8", xml_decl=True):
     return data.decode(encoding)
 
 
+def read_finess_lines(lines, keys, dtype):
+    """
+        Lecture des lignes (octets ISO-8859-1) d'un type d'enregistrement etalab
+    :param lines: lignes sans fin de ligne
+    :param keys: noms des colonnes
+    :param dtype: types des colonnes
+    :return: dataframe
+    """
+    if not lines:
+        return pandas.DataFrame(columns=keys, dtype=str)
+    return pandas.read_csv(
+        io.BytesIO(b"\n".join(lines)),
+        delimiter=";",
+        names=keys,
+        header=None,
+        index_col=False,
+        dtype=dtype,
+        encoding="iso-8859-1",
+    )
+
+
+def derive_finess(df):
+    """
+        Calcul des valeurs dérivées des structures utilisées lors de la construction
+        des bundles : ligne d'adresse, code postal, ville, extensions présentes,
+        présence du SIRET
+    :param df: dataframe structureet, complété
+    :return: dataframe
+    """
+
+    def join(left, right):
+        # concatenation avec espace, en ignorant les valeurs absentes
+        return (left + " " + right).fillna(left).fillna(right)
+
+    # typvoie et voie absents sont conservés sous la forme "nan"
+    line = join(df.numvoie, df.typvoie.fillna("nan"))
+    line = join(line, df.compvoie)
+    df["address_line"] = join(line, df.voie.fillna("nan"))
+
+    acheminement = df.ligneacheminement.str.extract(r"^(\d+)\s(.*)")
+    df["postal_code"] = acheminement[0]
+    df["city"] = acheminement[1]
+
+    # extensions présentes : (url, system, code, libellé), libellé None si sans objet
+    present = df[[ext[0] for ext in GHT.ET_EXTENSIONS]].notna().values
+    codes = df[[ext[0] for ext in GHT.ET_EXTENSIONS]].values
+    displays = df[[ext[1] or ext[0] for ext in GHT.ET_EXTENSIONS]].values
+    df["extensions"] = [
+        tuple(
+            (url, system, code, display if display_col else None)
+            for (_, display_col, url, system), flag, code, display in zip(
+                GHT.ET_EXTENSIONS, row_present, row_codes, row_displays
+            )
+            if flag
+        )
+        for row_present, row_codes, row_displays in zip(present, codes, displays)
+    ]
+    df["has_siret"] = df.siret.notna()
+    return df
+
+
+def read_finess_range(filename, start, end, skip, ej_filter):
+    """
+        Lecture d'un bloc [start, end[ du fichier etalab, aligné sur des debuts de ligne
+        (execution dans un processus de lecture)
+
+    :param filename: fichier etalab
+    :param start: position du debut du bloc
+    :param end: position de la fin du bloc
+    :param skip: positions des lignes a ignorer (1eres lignes de chaque type, lues
+                 comme entête lors de la lecture séquentielle)
+    :param ej_filter: ensemble des finess EJ a conserver, tous si None
+    :return: dataframes structureet (avec ses valeurs dérivées) et geolocalisation du bloc
+    """
+    with open(filename, "rb") as fin:
+        with mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            data = mm[start:end]
+
+    if ej_filter is not None:
+        ej_filter = set(ej.encode("iso-8859-1") for ej in ej_filter)
+
+    finess = []
+    finess_geo = []
+    offset = start
+    for line in data.split(b"\n"):
+        line_start = offset
+        offset += len(line) + 1
+        if line_start in skip:
+            continue
+        if line.startswith(b"structureet"):
+            if ej_filter is None or line.split(b";", 3)[2] in ej_filter:
+                finess.append(line)
+        elif line.startswith(b"geolocalisation"):
+            finess_geo.append(line)
+
+    return (
+        derive_finess(read_finess_lines(finess, GHT.FINESS_KEYS, str)),
+        read_finess_lines(finess_geo, GHT.GEOFINESS_KEYS, {"nofinesset": str}),
+    )
+
+
+def read_finess_parallel(filename, jobs, ej_filter=None):
+    """
+        Lecture du fichier etalab par blocs, en parallele dans jobs processus.
+        Le fichier est projeté en memoire (mmap) et decoupé en blocs alignés sur
+        des debuts de ligne ; les resultats sont concaténés dans l'ordre du fichier.
+
+    :param filename: fichier etalab
+    :param jobs: nombre de processus
+    :param ej_filter: ensemble des finess EJ a conserver, tous si None
+    :return: dataframes structureet et geolocalisation
+    """
+    with open(filename, "rb") as fin:
+        with mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            size = len(mm)
+            bounds = [0]
+            for num in range(1, jobs):
+                pos = mm.find(b"\n", max(bounds[-1], size * num // jobs))
+                bounds.append(size if pos < 0 else pos + 1)
+            bounds.append(size)
+
+            # la 1ere ligne de chaque type est ignorée, comme en lecture séquentielle
+            skip = set()
+            for prefix in (b"structureet", b"geolocalisation"):
+                if mm[: len(prefix)] == prefix:
+                    skip.add(0)
+                elif mm.find(b"\n" + prefix) >= 0:
+                    skip.add(mm.find(b"\n" + prefix) + 1)
+
+    ranges = [(bounds[i], bounds[i + 1]) for i in range(jobs) if bounds[i] < bounds[i + 1]]
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        results = list(
+            executor.map(
+                read_finess_range,
+                [filename] * len(ranges),
+                [start for start, _ in ranges],
+                [end for _, end in ranges],
+                [skip] * len(ranges),
+                [ej_filter] * len(ranges),
+            )
+        )
+
+    def concat(frames):
+        # les blocs ne contenant que l'autre type d'enregistrement sont vides
+        frames = [df for df in frames if not df.empty] or frames[:1]
+        return pandas.concat(frames, ignore_index=True)
+
+    df_finess = concat([res[0] for res in results])
+    df_finess_geo = concat([res[1] for res in results])
+    if ej_filter is not None:
+        df_finess_geo = df_finess_geo[
+            df_finess_geo.nofinesset.isin(set(df_finess.nofinesset))
+        ].reset_index(drop=True)
+    return df_finess, df_finess_geo
+
+
+class Record:
+    """
+        Enregistrement compact (__slots__) : les valeurs sont passées dans l'ordre des slots
+    """
+
+    __slots__ = ()
+
+
+class EJRecord(Record):
+    """
+        Entité juridique membre d'un GHT (ligne du fichier du ministère)
+    """
+
+    __slots__ = ("index", "finess", "etablissement")
+
+    def __init__(self, index, finess, etablissement):
+        self.index = index
+        self.finess = finess
+        self.etablissement = etablissement
+
+
+class ETRecord(Record):
+    """
+        Entité géographique (structureet) et ses valeurs dérivées
+    """
+
+    __slots__ = (
+        "nofinesset",
+        "nofinessej",
+        "rs",
+        "categetab",
+        "datemaj",
+        "dateouv",
+        "siret",
+        "has_siret",
+        "address_line",
+        "postal_code",
+        "city",
+        "extensions",
+    )
+
+    def __init__(
+        self,
+        nofinesset,
+        nofinessej,
+        rs,
+        categetab,
+        datemaj,
+        dateouv,
+        siret,
+        has_siret,
+        address_line,
+        postal_code,
+        city,
+        extensions,
+    ):
+        self.nofinesset = nofinesset
+        self.nofinessej = nofinessej
+        self.rs = rs
+        self.categetab = categetab
+        self.datemaj = datemaj
+        self.dateouv = dateouv
+        self.siret = siret
+        self.has_siret = has_siret
+        self.address_line = address_line
+        self.postal_code = postal_code
+        self.city = city
+        self.extensions = extensions
+
+
+class GeoRecord(Record):
+    """
+        Géolocalisation d'une entité géographique
+    """
+
+    __slots__ = ("nofinesset", "coordxet", "coordyet", "sourcecoordet")
+
+    def __init__(self, nofinesset, coordxet, coordyet, sourcecoordet):
+        self.nofinesset = nofinesset
+        self.coordxet = coordxet
+        self.coordyet = coordyet
+        self.sourcecoordet = sourcecoordet
+
+
+# fragments constants des ressources, partagés par toutes les ressources produites.
+# Ils ne doivent pas etre modifiés : les dictionnaires restent modifiables, seules
+# les listes sont des tuples (serialisés a l'identique en JSON)
+ORGANIZATION_TYPE = (
+    dict(
+        coding=(
+            dict(
+                system="http://hl7.org/fhir/organization-type",
+                code="prov",
+                display="Healthcare Provider",
+            ),
+        )
+    ),
+)
+XHTML_DIV = '<div xmlns="http://www.w3.org/1999/xhtml">'
+
+
 class GHT:
     GHT_KEYS = [
         "region",
@@ -145,22 +411,73 @@ class GHT:
         "datemaj",
     ]
 
+    # extensions des entités géographiques : colonne code, colonne libellé, url, system
+    ET_EXTENSIONS = [
+        (
+            "codeape",
+            None,
+            "https://opikanoba.org/fhir/StructureDefinition/fr-insee-APE",
+            "http://insee.fr/valuesets/APE",
+        ),
+        (
+            "categetab",
+            "libcategetab",
+            "https://opikanoba.org/fhir/StructureDefinition/fr-gouv-sante-finess-cat-etab",
+            "http://finess.sante.gouv.fr/valuesets/CAT_ETAB",
+        ),
+        (
+            "categagretab",
+            "libcategagretab",
+            "https://opikanoba.org/fhir/StructureDefinition/fr-gouv-sante-finess-cat-agr-etab",
+            "http://finess.sante.gouv.fr/valuesets/CAT_AGR_ETAB",
+        ),
+        (
+            "codemft",
+            "libmft",
+            "https://opikanoba.org/fhir/StructureDefinition/fr-gouv-sante-finess-MFT",
+            "http://finess.sante.gouv.fr/valuesets/MFT",
+        ),
+        (
+            "codesph",
+            "libsph",
+            "https://opikanoba.org/fhir/StructureDefinition/fr-gouv-sante-finess-SPH",
+            "http://finess.sante.gouv.fr/valuesets/SPH",
+        ),
+    ]
+
     SRCDIR = "files"
 
     def __init__(self):
         self.df_ght = None
         self.df_finess = None
         self.df_finess_geo = None
+        self.et_by_ej = {}
+        self.geo_by_et = {}
 
-    def load_data(self, ght_def_filename, etalab_filename):
+    def load_data(self, ght_def_filename, etalab_filename, prefilter=False, codes=None):
         """
             lecture definition GHT
         :param ght_def_filename: Fichier des données contenant la liste des etablissements
         :param etalab_filename: Fichier des finess
+        :param prefilter: ne conserve que les finess des entités juridiques des GHT
+        :param codes: codes GHT a conserver (si prefilter), tous les codes si None
         :return: -
 
         """
+        self.load_ght(ght_def_filename)
+
+        ej_filter = None
+        if prefilter:
+            ej_filter = self.ej_numbers(codes)
 
+        self.load_finess(etalab_filename, ej_filter)
+
+    def load_ght(self, ght_def_filename):
+        """
+            lecture du fichier du ministère definissant les GHT
+        :param ght_def_filename: Fichier des données contenant la liste des etablissements
+        :return: -
+        """
         local_filename = ght_def_filename
         if not ght_def_filename or not os.path.exists(ght_def_filename):
             dgosfiles = sorted(
@@ -184,6 +501,27 @@ class GHT:
         _keys[0:len(GHT.GHT_KEYS)] = GHT.GHT_KEYS
         self.df_ght.columns = _keys
 
+    def ej_numbers(self, codes=None):
+        """
+            Numeros finess des entités juridiques membres des GHT
+        :param codes: liste des codes GHT a retenir, tous les codes si None
+        :return: ensemble des numeros finess EJ
+        """
+        df = self.df_ght
+        if codes is not None:
+            df = df[df.ght_code.isin(codes)]
+        return set(df["finess"].dropna().tolist())
+
+    def load_finess(self, etalab_filename, ej_filter=None, jobs=1):
+        """
+            lecture du fichier des finess etalab
+        :param etalab_filename: Fichier des finess
+        :param ej_filter: ensemble des finess EJ a conserver, tout le fichier si None
+        :param jobs: nombre de processus de lecture (lecture par blocs si > 1). Les
+                     processus ne conservent alors que les structures des EJ membres
+                     d'un GHT, si la liste des GHT est chargée
+        :return: -
+        """
         local_filename = etalab_filename
         if not etalab_filename or not os.path.exists(etalab_filename):
             # recherche d'un fichier present
@@ -202,16 +540,29 @@ class GHT:
                 # fichier absent, telechargement
                 local_filename = srcdata.download_data_gouv_finess(GHT.SRCDIR)
 
+        if jobs > 1:
+            if ej_filter is None and self.df_ght is not None:
+                # seules ces structures sont converties par prepare_finess
+                ej_filter = self.ej_numbers()
+            self.df_finess, self.df_finess_geo = read_finess_parallel(
+                local_filename, jobs, ej_filter
+            )
+            self.prepare_finess()
+            return
+
         # lecture fichier etalab
         finess = io.StringIO()
         finess_geo = io.StringIO()
 
-        with codecs.open(local_filename, "r", "iso-8859-1") as fin:
-            for line in fin.readlines():
-                if line.startswith("structureet"):
-                    finess.write(line)
-                if line.startswith("geolocalisation"):
-                    finess_geo.write(line)
+        if ej_filter is None:
+            with codecs.open(local_filename, "r", "iso-8859-1") as fin:
+                for line in fin.readlines():
+                    if line.startswith("structureet"):
+                        finess.write(line)
+                    if line.startswith("geolocalisation"):
+                        finess_geo.write(line)
+        else:
+            self._filter_finess(local_filename, ej_filter, finess, finess_geo)
 
         finess.seek(0)
         finess_geo.seek(0)
@@ -230,7 +581,77 @@ class GHT:
             names=GHT.GEOFINESS_KEYS,
             header=0,
             index_col=False,
+            dtype={"nofinesset": str},
         )
+        self.prepare_finess()
+
+    def prepare_finess(self):
+        """
+            Calcul, en une fois pour tout le fichier, des valeurs dérivées des
+            structures utilisées lors de la construction des bundles :
+            ligne d'adresse, code postal, ville, extensions présentes, présence du SIRET
+            (déjà calculées par bloc lors de la lecture parallele).
+            Les structures sont ensuite converties en ETRecord regroupés par entité
+            juridique, les géolocalisations en GeoRecord indexés par finess ET.
+            Seules les structures des EJ membres d'un GHT (toutes si la liste des GHT
+            n'est pas chargée) et leurs géolocalisations sont converties.
+        :return: -
+        """
+        df = self.df_finess
+        df_geo = self.df_finess_geo
+        if self.df_ght is not None:
+            df = df[df.nofinessej.isin(self.ej_numbers())]
+            df_geo = df_geo[df_geo.nofinesset.isin(set(df.nofinesset))]
+        if "extensions" not in df.columns:
+            # valeurs non calculées lors de la lecture par blocs
+            df = derive_finess(df.copy())
+
+        self.et_by_ej = {}
+        for values in df[list(ETRecord.__slots__)].itertuples(index=False, name=None):
+            et = ETRecord(*values)
+            self.et_by_ej.setdefault(et.nofinessej, []).append(et)
+
+        self.geo_by_et = {}
+        for values in df_geo[list(GeoRecord.__slots__)].itertuples(
+            index=False, name=None
+        ):
+            self.geo_by_et.setdefault(values[0], GeoRecord(*values))
+
+    @staticmethod
+    def _filter_finess(filename, ej_filter, finess, finess_geo):
+        """
+            Lecture du fichier etalab en ne conservant que les structures
+            rattachées aux EJ demandées, et leurs géolocalisations.
+
+            Le fichier etalab liste toutes les structures avant les géolocalisations :
+            l'ensemble des ET retenus est donc complet lors de la lecture des
+            géolocalisations.
+            La 1ere ligne de chaque type est toujours conservée : elle est consommée
+            comme entête par read_csv (comportement de la lecture complète).
+
+        :param filename: fichier etalab
+        :param ej_filter: ensemble des finess EJ a conserver
+        :param finess: flux de sortie des lignes structureet
+        :param finess_geo: flux de sortie des lignes geolocalisation
+        :return: -
+        """
+        et_kept = set()
+        first_et = first_geo = True
+
+        with codecs.open(filename, "r", "iso-8859-1") as fin:
+            for line in fin:
+                if line.startswith("structureet"):
+                    fields = line.split(";", 3)
+                    if first_et or fields[2] in ej_filter:
+                        finess.write(line)
+                        if not first_et:
+                            et_kept.add(fields[1])
+                        first_et = False
+                elif line.startswith("geolocalisation"):
+                    fields = line.split(";", 2)
+                    if first_geo or fields[1] in et_kept:
+                        finess_geo.write(line)
+                        first_geo = False
 
     def ght_codes(self):
         """
@@ -252,6 +673,46 @@ class GHT:
                 li.append(newelem)
         return li
 
+    def ght_weights(self):
+        """
+            Poids de chaque GHT : nombre d'établissements listés dans le fichier du ministère
+        :return: dictionnaire code GHT -> nombre d'établissements
+        """
+        return self.df_ght["ght_code"].dropna().value_counts().to_dict()
+
+    def shard_codes(self, codes, index, count):
+        """
+            Répartition déterministe des codes GHT en count lots de poids équivalents.
+            Les GHT sont affectés du plus lourd au plus léger au lot le moins chargé,
+            l'ordre ne dépendant que du fichier du ministère : chaque noeud calcule
+            la même répartition.
+
+        :param codes: liste des codes GHT a répartir
+        :param index: numero du lot (de 1 a count)
+        :param count: nombre de lots
+        :return: liste des codes GHT du lot index
+        """
+        weights = self.ght_weights()
+        loads = [0] * count
+        shards = [[] for _ in range(count)]
+
+        for code in sorted(codes, key=lambda c: (-weights.get(c, 0), c)):
+            target = loads.index(min(loads))
+            shards[target].append(code)
+            loads[target] += weights.get(code, 0)
+
+        return [code for code in codes if code in shards[index - 1]]
+
+    @staticmethod
+    def ght_id(ght_code):
+        """
+            Identifiant FHIR du GHT
+        :param ght_code: code du GHT
+        :return: id du GHT
+        """
+        # ght-MAR_01 n'est pas 1 ID valid -> ght-MAR-01
+        return "ght-%s" % ght_code.replace("_", "-")
+
     def make_ght_bundle(self, ght_code):
         """
             Construction du bundle pour 1 GHT donné.
@@ -259,11 +720,78 @@ class GHT:
         :param ght_code: id du GHT. Remplacement des _ par des -
         :return: bundle FHIR en JSON
         """
-
-        # ght-MAR_01 n'est pas 1 ID valid -> ght-MAR-01
-        id_ght = "ght-%s" % ght_code.replace("_", "-")
-        bundle = dict(resourceType="Bundle", id=f"bundle-{id_ght}", entry=[])
+        bundle = dict(
+            resourceType="Bundle",
+            id=f"bundle-{GHT.ght_id(ght_code)}",
+            entry=list(self.ght_entries(ght_code)),
+        )
         bundle["type"] = "document"
+        return bundle
+
+    def make_ght_pages(self, ght_code, max_entries=None, max_bytes=None):
+        """
+            Construction du GHT sous forme d'une suite de bundles (pages) chainés
+            par des liens previous/next. Les pages sont produites une à une.
+
+        :param ght_code: id du GHT
+        :param max_entries: nombre maximum d'entrées par page
+        :param max_bytes: taille JSON maximum (approximative) des entrées d'une page
+        :return: generateur de bundles FHIR en JSON
+        """
+        id_bundle = f"bundle-{GHT.ght_id(ght_code)}"
+        entries = self.ght_entries(ght_code)
+
+        def next_entry():
+            # entree suivante et sa taille une fois indentee dans le tableau entry
+            # de la page, calculée une seule fois et seulement si la taille est limitée
+            entry = next(entries, None)
+            if entry is None or not max_bytes:
+                return entry, 0
+            text = json.dumps(entry, indent=2)
+            return entry, len(text) + 4 * text.count("\n") + 6
+
+        pending, size = next_entry()
+        page_num = 1
+
+        while pending is not None:
+            page = []
+            page_bytes = 0
+            while pending is not None:
+                if page and (
+                    (max_entries and len(page) >= max_entries)
+                    or (max_bytes and page_bytes + size > max_bytes)
+                ):
+                    break
+                page.append(pending)
+                page_bytes += size
+                pending, size = next_entry()
+
+            links = [dict(relation="self", url=f"Bundle/{id_bundle}-p{page_num}")]
+            if page_num > 1:
+                links.append(
+                    dict(relation="previous", url=f"Bundle/{id_bundle}-p{page_num - 1}")
+                )
+            if pending is not None:
+                links.append(
+                    dict(relation="next", url=f"Bundle/{id_bundle}-p{page_num + 1}")
+                )
+
+            bundle = dict(resourceType="Bundle", id=f"{id_bundle}-p{page_num}")
+            bundle["type"] = "collection"
+            bundle["link"] = links
+            bundle["entry"] = page
+            yield bundle
+            page_num += 1
+
+    def ght_entries(self, ght_code):
+        """
+            Production des entrées du bundle d'1 GHT donné : le GHT, puis chaque
+            entité juridique suivie de ses entités géographiques et localisations.
+
+        :param ght_code: id du GHT
+        :return: generateur d'entrées du bundle FHIR en JSON
+        """
+        id_ght = GHT.ght_id(ght_code)
 
         ght_name = self.df_ght.loc[
             self.df_ght.ght_code == ght_code
@@ -286,329 +814,835 @@ class GHT:
             address=[dict(state=ght_state)],
         )
 
-        bundle["entry"].append(dict(resource=org_ght))
+        yield dict(resource=org_ght)
 
-        for index, row in self.df_ght[self.df_ght.ght_code == ght_code].iterrows():
-            # entite juridique
-            ej_id = "%s-%s" % (str(row.finess).strip(), index)
+        df_ej = self.df_ght[self.df_ght.ght_code == ght_code]
+        for values in df_ej[["finess", "etablissement"]].itertuples(name=None):
+            ej = EJRecord(*values)
+            yield from self.ej_entries(ej, id_ght)
 
-            res_org = dict(
+    def ej_entries(self, ej, id_ght):
+        """
+            Production des entrées d'une entité juridique : l'entité juridique,
+            puis ses entités géographiques et leurs localisations
+
+        :param ej: EJRecord
+        :param id_ght: id du GHT
+        :return: generateur d'entrées du bundle FHIR en JSON
+        """
+        finess = str(ej.finess).strip()
+        ej_id = "%s-%s" % (finess, ej.index)
+
+        res_org = dict(
+            resourceType="Organization",
+            id=ej_id,
+            text=dict(
+                status="generated",
+                div=f"{XHTML_DIV}Entité Juridique - finess {ej.finess}</div>",
+            ),
+            name=ej.etablissement,
+        )
+        res_org["identifier"] = [
+            dict(use="official", system="urn:fr-gouv-sante-finess:ej", value=finess)
+        ]
+        res_org["type"] = ORGANIZATION_TYPE
+        res_org["partOf"] = dict(reference=f"Organization/{id_ght}")
+        yield dict(resource=res_org)
+
+        et_div = f"{XHTML_DIV}Entité Géographique - finess {ej.finess}</div>"
+        ej_ref = f"Organization/{ej_id}"
+
+        for et in self.et_by_ej.get(ej.finess, ()):
+            # categetab	libcategetab
+            # 355	Centre Hospitalier (C.H.)
+            # 101	Centre Hospitalier Régional (C.H.R.)
+            if not et.categetab:
+                continue
+
+            # entite geo
+            eg_id = "%s-%s" % (finess, et.nofinesset)
+            res_org_et = dict(
                 resourceType="Organization",
-                id=ej_id,
-                text=dict(
-                    status="generated",
-                    div=f"""<div xmlns=\"http://www.w3.org/1999/xhtml\">Entité Juridique - finess {row.finess}</div>""",
-                ),
-                name=row.etablissement,
+                id=eg_id,
+                text=dict(status="generated", div=et_div),
+                name=et.rs,
+                meta={"lastUpdated": f"{et.datemaj}T00:00:00Z"},
+                extension=[],
             )
-            res_org["identifier"] = [
+
+            # code APE, categorie etab, categorie agregat etab, MFT, SPH
+            for url, system, code, display in et.extensions:
+                coding = dict(system=system, code=code)
+                if display is not None:
+                    coding["display"] = display
+                res_org_et["extension"].append(dict(url=url, valueCoding=coding))
+
+            res_org_et["identifier"] = [
                 dict(
                     use="official",
-                    system="urn:fr-gouv-sante-finess:ej",
-                    value=str(row.finess).strip(),
+                    system="urn:fr-gouv-sante-finess:eg",
+                    value=et.nofinesset,
+                    period={"start": et.dateouv},
                 )
             ]
-            res_org["type"] = [
-                dict(
-                    coding=[
-                        dict(
-                            system="http://hl7.org/fhir/organization-type",
-                            code="prov",
-                            display="Healthcare Provider",
-                        )
-                    ]
+            if et.has_siret:
+                res_org_et["identifier"].append(
+                    dict(use="official", system="urn:fr-insee:SIRET", value=et.siret)
                 )
-            ]
-            res_org["partOf"] = dict(reference=f"Organization/{str(id_ght)}")
-            bundle["entry"].append(dict(resource=res_org))
-
-            for index_et, row_et in self.df_finess[
-                self.df_finess.nofinessej == row.finess
-            ].iterrows():
-                # categetab	libcategetab
-                # 355	Centre Hospitalier (C.H.)
-                # 101	Centre Hospitalier Régional (C.H.R.)
-                eg_id = "%s-%s" % (str(row.finess).strip(), row_et.nofinesset)
-
-                if row_et.categetab:
-                    # in ["101", "355"]:
-                    # entite geo
-                    res_org_et = dict(
-                        resourceType="Organization",
-                        id=eg_id,
-                        text=dict(
-                            status="generated",
-                            div=f"""<div xmlns=\"http://www.w3.org/1999/xhtml\">Entité Géographique - finess {row.finess}</div>""",
-                        ),
-                        name=row_et.rs,
-                        meta={"lastUpdated": f"{row_et.datemaj}T00:00:00Z"},
-                        extension=[],
-                    )
+            res_org_et["type"] = ORGANIZATION_TYPE
+
+            address = dict(use="work", line=[et.address_line])
+            if isinstance(et.postal_code, str):
+                address["postalCode"] = et.postal_code
+                address["city"] = et.city
+            res_org_et["address"] = [address]
+
+            res_org_et["partOf"] = dict(reference=ej_ref)
+            yield dict(resource=res_org_et)
+
+            # Localisation GPS
+            geo = self.geo_by_et.get(et.nofinesset)
+            if geo is None:
+                continue
+
+            location = dict(resourceType="Location", id="%s-loc" % eg_id)
+            if isinstance(geo.sourcecoordet, str) and "LAMBERT_93" in geo.sourcecoordet:
+                x, y = self.convert_coordinates(
+                    float(geo.coordxet), float(geo.coordyet), "LAMBERT_93"
+                )
+            else:
+                x, y = float(geo.coordxet), float(geo.coordyet)
 
-                    # code APE
-                    if str(row_et.codeape) != "nan":
-                        ape_ext = dict(
-                            url="https://opikanoba.org/fhir/StructureDefinition/fr-insee-APE",
-                            valueCoding=dict(
-                                system="http://insee.fr/valuesets/APE",
-                                code=row_et.codeape,
-                            ),
-                        )
-                        res_org_et["extension"].append(ape_ext)
-
-                    # categorie etab
-                    if str(row_et.categetab) != "nan":
-                        cat_ext = dict(
-                            url="https://opikanoba.org/fhir/StructureDefinition/fr-gouv-sante-finess-cat-etab",
-                            valueCoding=dict(
-                                system="http://finess.sante.gouv.fr/valuesets/CAT_ETAB",
-                                code=row_et.categetab,
-                                display=row_et.libcategetab,
-                            ),
-                        )
-                        res_org_et["extension"].append(cat_ext)
-
-                    # categorie agregat etab
-                    if str(row_et.categagretab) != "nan":
-                        catagr_ext = dict(
-                            url="https://opikanoba.org/fhir/StructureDefinition/fr-gouv-sante-finess-cat-agr-etab",
-                            valueCoding=dict(
-                                system="http://finess.sante.gouv.fr/valuesets/CAT_AGR_ETAB",
-                                code=row_et.categagretab,
-                                display=row_et.libcategagretab,
-                            ),
-                        )
-                        res_org_et["extension"].append(catagr_ext)
-
-                    # MFT
-                    if str(row_et.codemft) != "nan":
-                        mft_ext = dict(
-                            url="https://opikanoba.org/fhir/StructureDefinition/fr-gouv-sante-finess-MFT",
-                            valueCoding=dict(
-                                system="http://finess.sante.gouv.fr/valuesets/MFT",
-                                code=row_et.codemft,
-                                display=row_et.libmft,
-                            ),
-                        )
-                        res_org_et["extension"].append(mft_ext)
-
-                    # SPH
-                    if str(row_et.codesph) != "nan":
-                        sph_ext = dict(
-                            url="https://opikanoba.org/fhir/StructureDefinition/fr-gouv-sante-finess-SPH",
-                            valueCoding=dict(
-                                system="http://finess.sante.gouv.fr/valuesets/SPH",
-                                code=row_et.codesph,
-                                display=row_et.libsph,
-                            ),
-                        )
-                        res_org_et["extension"].append(sph_ext)
-
-                    res_org_et["identifier"] = [
-                        dict(
-                            use="official",
-                            system="urn:fr-gouv-sante-finess:eg",
-                            value=row_et.nofinesset,
-                            period={"start": row_et.dateouv},
-                        )
-                    ]
-                    if str(row_et.siret) != "nan":
-                        res_org_et["identifier"].append(
-                            dict(
-                                use="official",
-                                system="urn:fr-insee:SIRET",
-                                value=row_et.siret,
-                            )
-                        )
-                    res_org_et["type"] = [
-                        dict(
-                            coding=[
-                                dict(
-                                    system="http://hl7.org/fhir/organization-type",
-                                    code="prov",
-                                    display="Healthcare Provider",
-                                )
-                            ]
-                        )
-                    ]
-                    line_vals = []
-
-                    if str(row_et.numvoie) != "nan":
-                        line_vals.append(str(row_et.numvoie))
-                    if row_et.typvoie:
-                        line_vals.append(str(row_et.typvoie))
-                    if str(row_et.compvoie) != "nan":
-                        line_vals.append(str(row_et.compvoie))
-                    if row_et.voie:
-                        line_vals.append(str(row_et.voie))
-
-                    res_org_et["address"] = [
-                        dict(use="work", line=[" ".join(line_vals)])
-                    ]
-                    res = re.match(r"(\d+)\s(.*)", row_et.ligneacheminement)
-                    if res:
-                        postalCode, city = res.groups()
-                        res_org_et["address"][0]["postalCode"] = postalCode
-                        res_org_et["address"][0]["city"] = city
-
-                    res_org_et["partOf"] = dict(reference=f"Organization/{ej_id}")
-                    bundle["entry"].append(dict(resource=res_org_et))
-
-                    # Localisation GPS
-                    location = dict(resourceType="Location", id="%s-loc" % eg_id)
-                    geo = self.df_finess_geo[
-                        self.df_finess_geo.nofinesset == row_et.nofinesset
-                    ]
-                    if geo.sourcecoordet.str.contains("LAMBERT_93").bool():
-                        x, y = self.convert_coordinates(
-                            float(geo.coordxet), float(geo.coordyet), "LAMBERT_93"
-                        )
-                    else:
-                        x, y = float(geo.coordxet), float(geo.coordyet)
+            location["position"] = dict(longitude=x, latitude=y)
+            location["managingOrganization"] = dict(reference=f"Organization/{eg_id}")
+            yield dict(resource=location)
 
-                    location["position"] = dict(longitude=x, latitude=y)
-                    location["managingOrganization"] = dict(
-                        reference=f"Organization/{eg_id}"
-                    )
-                    bundle["entry"].append(dict(resource=location))
-        return bundle
+    PROJECTIONS = {}
 
     def convert_coordinates(self, xin, yin, proj):
         if proj == "LAMBERT_93":
-            inProj = Proj(init="epsg:2154")
-            outProj = Proj(init="epsg:4326")
+            # projections creees une seule fois
+            if not GHT.PROJECTIONS:
+                GHT.PROJECTIONS["epsg:2154"] = Proj(init="epsg:2154")
+                GHT.PROJECTIONS["epsg:4326"] = Proj(init="epsg:4326")
+            inProj = GHT.PROJECTIONS["epsg:2154"]
+            outProj = GHT.PROJECTIONS["epsg:4326"]
             xout, yout = transform(inProj, outProj, xin, yin)
         else:
             xout, yout = xin, yin
         return xout, yout
 
-    def toxml(self, orgs):
+    def toxml(self, orgs, entries=True):
         """
             Production du fichier XML du bundle contenant les établissements du GHT
         :param orgs: bundle FHIR JSON contenant les entités du GHT
+        :param entries: production des entrées (sinon seule l'enveloppe du bundle est produite)
         :return: bundle FHIR XML
         """
         bundle = xmlelt(None, "Bundle", {"xmlns": "http://hl7.org/fhir"})
         xmlelt(bundle, "type", {"value": orgs["type"]})
 
+        for link in orgs.get("link", []):
+            link_elem = xmlelt(bundle, "link")
+            xmlelt(link_elem, "relation", {"value": link["relation"]})
+            xmlelt(link_elem, "url", {"value": link["url"]})
+
         bundle.append(lxml.etree.Comment(f"Entry count = {len(orgs['entry'])}"))
 
-        for entry in orgs["entry"]:
-            container = xmlelt(
-                xmlelt(xmlelt(bundle, "entry"), "resource"),
-                entry["resource"]["resourceType"],
+        if entries:
+            for entry in orgs["entry"]:
+                self.entry_toxml(xmlelt(bundle, "entry"), entry)
+        return bundle
+
+    def entry_toxml(self, parent, entry):
+        """
+            Production XML d'une entrée du bundle
+        :param parent: element XML entry
+        :param entry: entrée du bundle FHIR JSON
+        :return: element XML entry
+        """
+        container = xmlelt(
+            xmlelt(parent, "resource"),
+            entry["resource"]["resourceType"],
+        )
+        xmlelt(container, "id", {"value": str(entry["resource"]["id"])})
+
+        if (
+            "meta" in entry["resource"]
+            and "lastUpdated" in entry["resource"]["meta"]
+        ):
+            xmlelt(
+                xmlelt(container, "meta"),
+                "lastUpdated",
+                {"value": entry["resource"]["meta"]["lastUpdated"]},
             )
-            xmlelt(container, "id", {"value": str(entry["resource"]["id"])})
-
-            if (
-                "meta" in entry["resource"]
-                and "lastUpdated" in entry["resource"]["meta"]
-            ):
-                xmlelt(
-                    xmlelt(container, "meta"),
-                    "lastUpdated",
-                    {"value": entry["resource"]["meta"]["lastUpdated"]},
-                )
 
-            if "text" in entry["resource"]:
-                text = xmlelt(container, "text")
-                xmlelt(text, "status", {"value": entry["resource"]["text"]["status"]})
-                text.append(lxml.etree.fromstring(entry["resource"]["text"]["div"]))
+        if "text" in entry["resource"]:
+            text = xmlelt(container, "text")
+            xmlelt(text, "status", {"value": entry["resource"]["text"]["status"]})
+            text.append(lxml.etree.fromstring(entry["resource"]["text"]["div"]))
+
+        if "extension" in entry["resource"]:
+            for ext in entry["resource"]["extension"]:
+                ext_elem = xmlelt(container, "extension", {"url": ext["url"]})
+                if "valueCoding" in ext:
+                    val_coding = xmlelt(ext_elem, "valueCoding")
+                    xmlelt(
+                        val_coding,
+                        "system",
+                        {"value": ext["valueCoding"]["system"]},
+                    )
+
+                    xmlelt(
+                        val_coding, "code", {"value": ext["valueCoding"]["code"]}
+                    )
 
-            if "extension" in entry["resource"]:
-                for ext in entry["resource"]["extension"]:
-                    ext_elem = xmlelt(container, "extension", {"url": ext["url"]})
-                    if "valueCoding" in ext:
-                        val_coding = xmlelt(ext_elem, "valueCoding")
+                    if "display" in ext["valueCoding"]:
                         xmlelt(
                             val_coding,
-                            "system",
-                            {"value": ext["valueCoding"]["system"]},
+                            "display",
+                            {"value": ext["valueCoding"]["display"]},
                         )
+                if "valueCode" in ext:
+                    xmlelt(
+                        ext_elem, "valueCode", {"value": ext["valueCode"]["value"]}
+                    )
 
-                        xmlelt(
-                            val_coding, "code", {"value": ext["valueCoding"]["code"]}
-                        )
+        if "identifier" in entry["resource"]:
+            for ident in entry["resource"]["identifier"]:
+                ident_elem = xmlelt(container, "identifier")
+                xmlelt(ident_elem, "use", {"value": ident["use"]})
+                xmlelt(ident_elem, "system", {"value": ident["system"]})
+                xmlelt(ident_elem, "value", {"value": ident["value"]})
+                if "period" in ident:
+                    xmlelt(
+                        xmlelt(ident_elem, "period"),
+                        "start",
+                        {"value": ident["period"]["start"]},
+                    )
 
-                        if "display" in ext["valueCoding"]:
-                            xmlelt(
-                                val_coding,
-                                "display",
-                                {"value": ext["valueCoding"]["display"]},
-                            )
-                    if "valueCode" in ext:
-                        xmlelt(
-                            ext_elem, "valueCode", {"value": ext["valueCode"]["value"]}
-                        )
+        if "type" in entry["resource"]:
+            for current_type in entry["resource"]["type"]:
+                if "coding" in current_type:
+                    for cod in current_type["coding"]:
+                        coding = xmlelt(xmlelt(container, "type"), "coding")
+
+                        xmlelt(coding, "system", {"value": cod["system"]})
+                        xmlelt(coding, "code", {"value": cod["code"]})
+                        xmlelt(coding, "display", {"value": cod["display"]})
+
+        if "name" in entry["resource"]:
+            xmlelt(container, "name", {"value": entry["resource"]["name"]})
+
+        if "address" in entry["resource"]:
+            for addr in entry["resource"]["address"]:
+
+                addr_elem = xmlelt(container, "address")
+                if "use" in addr:
+                    xmlelt(addr_elem, "use", {"value": addr["use"]})
+                if "line" in addr:
+                    for line in addr["line"]:
+                        xmlelt(addr_elem, "line", {"value": line})
+
+                if "city" in addr:
+                    xmlelt(addr_elem, "city", {"value": addr["city"]})
+                if "postalCode" in addr:
+                    xmlelt(addr_elem, "postalCode", {"value": addr["postalCode"]})
+                if "state" in addr:
+                    xmlelt(addr_elem, "state", {"value": addr["state"]})
+
+        if "partOf" in entry["resource"]:
+            xmlelt(
+                xmlelt(container, "partOf"),
+                "reference",
+                {"value": entry["resource"]["partOf"]["reference"]},
+            )
+        if "position" in entry["resource"]:
+            pos = xmlelt(container, "position")
+            xmlelt(
+                pos,
+                "longitude",
+                {"value": str(entry["resource"]["position"]["longitude"])},
+            )
+            xmlelt(
+                pos,
+                "latitude",
+                {"value": str(entry["resource"]["position"]["latitude"])},
+            )
+        if "managingOrganization" in entry["resource"]:
+            xmlelt(
+                xmlelt(container, "managingOrganization"),
+                "reference",
+                {"value": entry["resource"]["managingOrganization"]["reference"]},
+            )
+        return parent
 
-            if "identifier" in entry["resource"]:
-                for ident in entry["resource"]["identifier"]:
-                    ident_elem = xmlelt(container, "identifier")
-                    xmlelt(ident_elem, "use", {"value": ident["use"]})
-                    xmlelt(ident_elem, "system", {"value": ident["system"]})
-                    xmlelt(ident_elem, "value", {"value": ident["value"]})
-                    if "period" in ident:
-                        xmlelt(
-                            xmlelt(ident_elem, "period"),
-                            "start",
-                            {"value": ident["period"]["start"]},
-                        )
 
-            if "type" in entry["resource"]:
-                for current_type in entry["resource"]["type"]:
-                    if "coding" in current_type:
-                        for cod in current_type["coding"]:
-                            coding = xmlelt(xmlelt(container, "type"), "coding")
-
-                            xmlelt(coding, "system", {"value": cod["system"]})
-                            xmlelt(coding, "code", {"value": cod["code"]})
-                            xmlelt(coding, "display", {"value": cod["display"]})
-
-            if "name" in entry["resource"]:
-                xmlelt(container, "name", {"value": entry["resource"]["name"]})
-
-            if "address" in entry["resource"]:
-                for addr in entry["resource"]["address"]:
-
-                    addr_elem = xmlelt(container, "address")
-                    if "use" in addr:
-                        xmlelt(addr_elem, "use", {"value": addr["use"]})
-                    if "line" in addr:
-                        for line in addr["line"]:
-                            xmlelt(addr_elem, "line", {"value": line})
-
-                    if "city" in addr:
-                        xmlelt(addr_elem, "city", {"value": addr["city"]})
-                    if "postalCode" in addr:
-                        xmlelt(addr_elem, "postalCode", {"value": addr["postalCode"]})
-                    if "state" in addr:
-                        xmlelt(addr_elem, "state", {"value": addr["state"]})
-
-            if "partOf" in entry["resource"]:
-                xmlelt(
-                    xmlelt(container, "partOf"),
-                    "reference",
-                    {"value": entry["resource"]["partOf"]["reference"]},
+def shard_spec(value):
+    """
+        Lecture d'une specification de lot i/N
+    :param value: texte i/N, avec 1 <= i <= N
+    :return: tuple (i, N)
+    """
+    res = re.match(r"^(\d+)/(\d+)$", value)
+    if not res or not 1 <= int(res.group(1)) <= int(res.group(2)):
+        raise argparse.ArgumentTypeError(f"lot [{value}] invalide, format attendu i/N")
+    return int(res.group(1)), int(res.group(2))
+
+
+def positive_int(value):
+    """
+        Lecture d'un entier strictement positif
+    :param value: texte de l'entier
+    :return: entier
+    """
+    try:
+        number = int(value)
+    except ValueError:
+        number = 0
+    if number <= 0:
+        raise argparse.ArgumentTypeError(
+            f"valeur [{value}] invalide, entier positif attendu"
+        )
+    return number
+
+
+def iso_date(value):
+    """
+        Lecture d'une date AAAA-MM-JJ
+    :param value: texte de la date
+    :return: date AAAA-MM-JJ
+    """
+    try:
+        return datetime.datetime.strptime(value, "%Y-%m-%d").date().isoformat()
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            f"date [{value}] invalide, format attendu AAAA-MM-JJ"
+        )
+
+
+def write_manifest(outputdir, shard, codes, files):
+    """
+        Ecriture du manifeste partiel d'un lot
+    :param outputdir: repertoire de destination
+    :param shard: tuple (i, N) du lot
+    :param codes: codes GHT generes par le lot
+    :param files: fichiers generes par le lot
+    :return: nom du fichier manifeste
+    """
+    index, count = shard
+    manifest = dict(
+        shard=f"{index}/{count}",
+        index=index,
+        count=count,
+        codes=codes,
+        files=files,
+    )
+    filename = os.path.join(outputdir, f"manifest-{index}-{count}.json")
+    atomic_write(filename, json.dumps(manifest, indent=2))
+    return filename
+
+
+def merge_manifests(outputdir, codes):
+    """
+        Fusion des manifestes partiels et controle de la couverture des codes GHT
+    :param outputdir: repertoire contenant les manifestes partiels
+    :param codes: liste des codes GHT attendus
+    :return: liste des erreurs constatées (vide si la couverture est complete)
+    """
+    errors = []
+    manifests = []
+    for filename in sorted(glob.glob(os.path.join(outputdir, "manifest-*-*.json"))):
+        with open(filename) as fin:
+            manifests.append(json.load(fin))
+
+    if not manifests:
+        return [f"Aucun manifeste partiel dans {outputdir}"]
+
+    counts = set(m["count"] for m in manifests)
+    if len(counts) > 1:
+        errors.append(f"Nombres de lots differents : {sorted(counts)}")
+    count = max(counts)
+
+    indexes = [m["index"] for m in manifests]
+    missing_shards = [i for i in range(1, count + 1) if i not in indexes]
+    if missing_shards:
+        errors.append(f"Lots manquants : {missing_shards}")
+
+    seen = {}
+    for m in sorted(manifests, key=lambda m: m["index"]):
+        for code in m["codes"]:
+            if code in seen:
+                errors.append(f"Code GHT {code} genere par les lots {seen[code]} et {m['shard']}")
+            else:
+                seen[code] = m["shard"]
+    missing_codes = [code for code in codes if code not in seen]
+    if missing_codes:
+        errors.append(f"Codes GHT non generes : {missing_codes}")
+
+    missing_files = [
+        f
+        for m in manifests
+        for f in m["files"]
+        if not os.path.exists(os.path.join(outputdir, f))
+    ]
+    if missing_files:
+        errors.append(f"Fichiers absents : {missing_files}")
+
+    manifest = dict(
+        count=count,
+        complete=not errors,
+        codes=[code for code in codes if code in seen],
+        files=[f for m in sorted(manifests, key=lambda m: m["index"]) for f in m["files"]],
+        errors=errors,
+    )
+    atomic_write(os.path.join(outputdir, "manifest.json"), json.dumps(manifest, indent=2))
+
+    # index global, a partir des index des lots
+    index_files = [
+        os.path.join(outputdir, f"index-{m['index']}-{m['count']}.ndjson")
+        for m in sorted(manifests, key=lambda m: m["index"])
+    ]
+    index_files = [f for f in index_files if os.path.exists(f)]
+    if index_files:
+        content = []
+        for filename in index_files:
+            with open(filename) as fin:
+                content.append(fin.read())
+        atomic_write(os.path.join(outputdir, "index.ndjson"), "".join(content))
+    return errors
+
+
+def ndjson_records(name, ght_code, orgs):
+    """
+        Serialisation des ressources d'un bundle au format NDJSON (1 ressource JSON compacte par ligne)
+        et production des enregistrements d'index (position en octets de chaque ressource)
+
+    :param name: nom du fichier, sans extension
+    :param ght_code: code du GHT
+    :param orgs: bundle FHIR JSON
+    :return: contenu NDJSON (octets), liste des enregistrements d'index
+    """
+    filename = f"{name}.ndjson"
+    lines = []
+    records = []
+    offset = 0
+
+    for entry in orgs["entry"]:
+        resource = entry["resource"]
+        data = json.dumps(resource, separators=(",", ":")).encode("utf-8")
+        lines.append(data)
+
+        finess = [
+            ident["value"]
+            for ident in resource.get("identifier", [])
+            if ident["system"].startswith("urn:fr-gouv-sante-finess")
+        ]
+        if resource["resourceType"] == "Location":
+            # localisation sans identifiant : finess ET de l'entité géographique
+            # gestionnaire, reference Organization/{finess EJ}-{finess ET}
+            finess.append(
+                resource["managingOrganization"]["reference"].rsplit("-", 1)[1]
+            )
+
+        records.append(
+            dict(
+                id=resource["id"],
+                resourceType=resource["resourceType"],
+                ght=ght_code,
+                file=filename,
+                offset=offset,
+                length=len(data),
+                finess=finess,
+            )
+        )
+        offset += len(data) + 1
+    return b"".join(line + b"\n" for line in lines), records
+
+
+def atomic_write(filename, data):
+    """
+        Ecriture d'un fichier via un fichier temporaire renommé : un arret en cours
+        d'ecriture ne laisse jamais de fichier tronqué
+    :param filename: fichier de destination
+    :param data: contenu texte ou octets
+    :return: nombre d'octets/caracteres ecrits
+    """
+    tmp = f"{filename}.{os.getpid()}-{threading.get_ident()}.tmp"
+    try:
+        with open(tmp, "wb" if isinstance(data, bytes) else "w") as fout:
+            fout.write(data)
+        os.replace(tmp, filename)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    return len(data)
+
+
+class FragmentCache:
+    """
+        Cache des entrées serialisées (JSON indenté et XML), adressé par le contenu :
+        la clé est l'id de la ressource et une empreinte de la ressource.
+        Une ressource inchangée d'une execution a l'autre, si le cache est conservé sur
+        disque, ou présente a l'identique dans plusieurs GHT n'est serialisée qu'une
+        fois : les bundles sont assemblés par concatenation des fragments.
+        Les ids des entités juridiques et géographiques comportent le rang de l'EJ dans
+        la liste du ministère : au sein d'une execution, seules les localisations
+        d'une EJ membre de plusieurs GHT sont réutilisées.
+        Tous les fragments produits restent en memoire jusqu'a la fin de l'execution.
+    """
+
+    FORMATS = ["json", "xml"]
+    # version du format des fragments : a incrementer si la serialisation des entrées
+    # change (entry_json, entry_xml, GHT.entry_toxml, xmlelt). Un cache conservé sur
+    # disque dans une autre version n'est pas réutilisé.
+    VERSION = 2
+    # marque de l'emplacement des entrées dans l'enveloppe JSON du bundle
+    ENTRIES_MARK = "\x00entries\x00"
+
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.fragments = {}
+        self.used = set()
+        # succès et echecs par format et par type de ressource
+        self.stats = {}
+
+        if filename and os.path.exists(filename):
+            self.fragments = FragmentCache.load(filename)
+
+    @staticmethod
+    def load(filename):
+        """
+            Lecture d'un cache conservé sur disque (JSON). Un fichier illisible ou d'une
+            autre version est ignoré : le cache est reconstruit.
+        :param filename: fichier du cache
+        :return: fragments
+        """
+        try:
+            with open(filename, "r", encoding="utf-8") as fin:
+                data = json.load(fin)
+        except Exception as e:
+            print(f"Cache {filename} illisible ({e}), reconstruction")
+            return {}
+
+        if (
+            not isinstance(data, dict)
+            or data.get("version") != FragmentCache.VERSION
+        ):
+            print(f"Cache {filename} d'une autre version, reconstruction")
+            return {}
+        # les fragments XML sont conservés en texte, utilisés en octets
+        return {
+            key: dict(json=fragments["json"], xml=fragments["xml"].encode("utf-8"))
+            for key, fragments in data["fragments"].items()
+        }
+
+    @staticmethod
+    def key(resource):
+        digest = hashlib.sha1(repr(resource).encode("utf-8")).hexdigest()
+        return f"{resource['id']}:{digest}"
+
+    def fragment(self, key, fmt, build, entry):
+        fragments = self.fragments.setdefault(key, {})
+        stat = self.stats.setdefault(
+            (fmt, entry["resource"]["resourceType"]), dict(hits=0, misses=0)
+        )
+        if fmt in fragments:
+            stat["hits"] += 1
+        else:
+            stat["misses"] += 1
+            fragments[fmt] = build(entry)
+        return fragments[fmt]
+
+    @staticmethod
+    def entry_json(entry):
+        # entrée indentée au niveau du tableau entry du bundle
+        return json.dumps(entry, indent=2).replace("\n", "\n    ")
+
+    @staticmethod
+    def entry_xml(ght, entry):
+        # entrée indentée au niveau des enfants de Bundle
+        data = lxml.etree.tostring(
+            ght.entry_toxml(xmlelt(None, "entry"), entry),
+            encoding="utf-8",
+            pretty_print=True,
+        )
+        return b"  " + data.rstrip(b"\n").replace(b"\n", b"\n  ") + b"\n"
+
+    def serialize(self, ght, orgs):
+        """
+            Serialisation d'un bundle a partir des fragments en cache
+        :param ght: objet GHT (production XML)
+        :param orgs: bundle FHIR JSON
+        :return: texte JSON, texte XML (identiques a json.dumps et xml2text)
+        """
+        if not orgs["entry"]:
+            return json.dumps(orgs, indent=2), xml2text(ght.toxml(orgs))
+
+        keys = [FragmentCache.key(entry["resource"]) for entry in orgs["entry"]]
+        self.used.update(keys)
+
+        json_entries = [
+            self.fragment(key, "json", FragmentCache.entry_json, entry)
+            for key, entry in zip(keys, orgs["entry"])
+        ]
+        shell = dict(orgs)
+        shell["entry"] = [FragmentCache.ENTRIES_MARK]
+        json_text = json.dumps(shell, indent=2).replace(
+            json.dumps(FragmentCache.ENTRIES_MARK), ",\n    ".join(json_entries), 1
+        )
+
+        xml_entries = [
+            self.fragment(key, "xml", lambda e: FragmentCache.entry_xml(ght, e), entry)
+            for key, entry in zip(keys, orgs["entry"])
+        ]
+        head = lxml.etree.tostring(
+            ght.toxml(orgs, entries=False),
+            encoding="utf-8",
+            pretty_print=True,
+            xml_declaration=True,
+        )
+        head, tail = head.rsplit(b"</Bundle>", 1)
+        xml_text = b"".join([head] + xml_entries + [b"</Bundle>", tail])
+
+        return json_text, xml_text.decode("utf-8")
+
+    def save(self):
+        """
+            Conservation sur disque des fragments utilisés lors de l'execution
+        :return: -
+        """
+        if self.filename:
+            fragments = {
+                key: dict(
+                    json=self.fragments[key]["json"],
+                    xml=self.fragments[key]["xml"].decode("utf-8"),
                 )
-            if "position" in entry["resource"]:
-                pos = xmlelt(container, "position")
-                xmlelt(
-                    pos,
-                    "longitude",
-                    {"value": str(entry["resource"]["position"]["longitude"])},
+                for key in self.used
+            }
+            atomic_write(
+                self.filename,
+                json.dumps(
+                    dict(version=FragmentCache.VERSION, fragments=fragments)
+                ).encode("utf-8"),
+            )
+
+    def report(self):
+        """
+            Taux de succès du cache, par format et par type de ressource
+        :return: liste de textes formattés
+        """
+        lines = []
+        for fmt in FragmentCache.FORMATS:
+            for (stat_fmt, resource_type), stat in sorted(self.stats.items()):
+                if stat_fmt != fmt:
+                    continue
+                total = stat["hits"] + stat["misses"]
+                rate = 100.0 * stat["hits"] / total if total else 0
+                lines.append(
+                    f"Cache {fmt} {resource_type} : {stat['hits']}/{total} fragments réutilisés ({rate:.1f}%)"
                 )
-                xmlelt(
-                    pos,
-                    "latitude",
-                    {"value": str(entry["resource"]["position"]["latitude"])},
+        return lines
+
+
+def serialize_bundle(ght, name, ght_code, orgs, index=False, cache=None):
+    """
+        Serialisation d'un bundle dans les differents formats de sortie
+    :param ght: objet GHT (production XML)
+    :param name: nom des fichiers, sans extension
+    :param ght_code: code du GHT
+    :param orgs: bundle FHIR JSON
+    :param index: production du NDJSON et des enregistrements d'index
+    :param cache: FragmentCache des entrées serialisées, aucun si None
+    :return: liste de (nom de fichier, contenu), liste des enregistrements d'index
+    """
+    if cache:
+        json_text, xml_text = cache.serialize(ght, orgs)
+    else:
+        json_text, xml_text = json.dumps(orgs, indent=2), xml2text(ght.toxml(orgs))
+
+    outputs = [(f"{name}.json", json_text), (f"{name}.xml", xml_text)]
+    records = []
+    if index:
+        data, records = ndjson_records(name, ght_code, orgs)
+        outputs.append((f"{name}.ndjson", data))
+    return outputs, records
+
+
+class PipelineWriter:
+    """
+        Production des fichiers en pipeline :
+        - construction des bundles par l'appelant (submit)
+        - serialisation JSON/XML dans un thread dedié
+        - ecriture des fichiers par un pool de threads
+
+        Les files d'attente entre etapes sont bornées : seuls quelques bundles
+        sont en memoire a un instant donné.
+    """
+
+    STAGES = ["construction", "serialisation", "ecriture"]
+
+    def __init__(
+        self, ght, outputdir, index=False, workers=4, queue_size=4, cache=None
+    ):
+        self.ght = ght
+        self.outputdir = outputdir
+        self.index = index
+        self.cache = cache
+        self.files = []
+        self.records = []
+        self.error = None
+
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.writes = threading.BoundedSemaphore(queue_size * workers)
+        self.futures = []
+
+        self.lock = threading.Lock()
+        self.stats = {
+            stage: dict(count=0, seconds=0.0, size=0) for stage in PipelineWriter.STAGES
+        }
+        self.start = self.last_submit = time.perf_counter()
+
+        self.thread = threading.Thread(target=self.serialize_loop, daemon=True)
+        self.thread.start()
+
+    def add_stat(self, stage, seconds, size=0):
+        with self.lock:
+            self.stats[stage]["count"] += 1
+            self.stats[stage]["seconds"] += seconds
+            self.stats[stage]["size"] += size
+
+    def submit(self, name, ght_code, orgs):
+        """
+            Prise en charge d'un bundle construit. Le temps de construction est le temps
+            passé par l'appelant depuis le submit précédent.
+        :param name: nom des fichiers, sans extension
+        :param ght_code: code du GHT
+        :param orgs: bundle FHIR JSON
+        :return: -
+        """
+        self.add_stat("construction", time.perf_counter() - self.last_submit)
+        if self.error:
+            raise self.error
+        self.queue.put((name, ght_code, orgs))
+        self.last_submit = time.perf_counter()
+
+    def serialize_loop(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            if self.error:
+                # vidage de la file apres une erreur, pour ne pas bloquer l'appelant
+                continue
+            try:
+                t0 = time.perf_counter()
+                outputs, records = serialize_bundle(
+                    self.ght, *item, index=self.index, cache=self.cache
                 )
-            if "managingOrganization" in entry["resource"]:
-                xmlelt(
-                    xmlelt(container, "managingOrganization"),
-                    "reference",
-                    {"value": entry["resource"]["managingOrganization"]["reference"]},
+                self.add_stat(
+                    "serialisation",
+                    time.perf_counter() - t0,
+                    sum(len(data) for _, data in outputs),
                 )
-        return bundle
+                self.records.extend(records)
+                for filename, data in outputs:
+                    self.files.append(filename)
+                    self.writes.acquire()
+                    self.futures.append(
+                        self.pool.submit(
+                            self.write, os.path.join(self.outputdir, filename), data
+                        )
+                    )
+            except Exception as e:
+                self.error = e
+
+    def write(self, filename, data):
+        try:
+            t0 = time.perf_counter()
+            size = atomic_write(filename, data)
+            self.add_stat("ecriture", time.perf_counter() - t0, size)
+        finally:
+            self.writes.release()
+
+    def close(self):
+        """
+            Attente de la fin de toutes les etapes
+        :return: liste des fichiers ecrits, liste des enregistrements d'index
+        """
+        self.queue.put(None)
+        self.thread.join()
+        try:
+            for future in self.futures:
+                future.result()
+        finally:
+            self.pool.shutdown()
+        if self.error:
+            raise self.error
+        return self.files, self.records
+
+    def report(self):
+        """
+            Debit de chaque etape
+        :return: liste de textes formattés
+        """
+        elapsed = time.perf_counter() - self.start
+        lines = [f"Pipeline : {elapsed:.2f}s"]
+        for stage in PipelineWriter.STAGES:
+            stat = self.stats[stage]
+            rate = stat["count"] / stat["seconds"] if stat["seconds"] else 0
+            line = f"{stage:>14} : {stat['count']} en {stat['seconds']:.2f}s ({rate:.1f}/s)"
+            if stat["size"]:
+                mbps = stat["size"] / stat["seconds"] / 1e6 if stat["seconds"] else 0
+                line += f", {stat['size'] / 1e6:.1f} Mo ({mbps:.1f} Mo/s)"
+            lines.append(line)
+        return lines
+
+
+def write_index(filename, records):
+    """
+        Ecriture de l'index des ressources (1 enregistrement JSON par ligne)
+    :param filename: fichier index
+    :param records: enregistrements produits par ndjson_records
+    :return: nom du fichier index
+    """
+    atomic_write(
+        filename,
+        "".join(json.dumps(record, separators=(",", ":")) + "\n" for record in records),
+    )
+    return filename
+
+
+def load_index(filename):
+    """
+        Lecture d'un index : chaque ressource est accessible par son id
+        et par ses numeros finess (EJ ou ET)
+
+    :param filename: fichier index
+    :return: dictionnaire clé -> liste des enregistrements (une ET donne son
+             organisation et sa localisation)
+    """
+    index = {}
+    with open(filename) as fin:
+        for line in fin:
+            record = json.loads(line)
+            for key in [record["id"]] + record["finess"]:
+                index.setdefault(key, []).append(record)
+    return index
+
+
+def read_resource(outputdir, record):
+    """
+        Lecture d'une seule ressource a partir de sa position dans le fichier NDJSON
+    :param outputdir: repertoire contenant les fichiers generes
+    :param record: enregistrement d'index
+    :return: ressource FHIR JSON
+    """
+    with open(os.path.join(outputdir, record["file"]), "rb") as fin:
+        fin.seek(record["offset"])
+        return json.loads(fin.read(record["length"]))
 
 
 def main():
@@ -634,10 +1668,99 @@ def main():
         help="Repertoire de destination des fichiers générés",
         default="output",
     )
+    parser.add_argument(
+        "--prefilter",
+        action="store_true",
+        help="Ne charge que les finess des entités juridiques des GHT demandés (--code)",
+    )
+    parser.add_argument(
+        "--shard",
+        type=shard_spec,
+        help="Ne genere que le lot i/N des codes GHT demandés (--code), avec un manifeste partiel",
+    )
+    parser.add_argument(
+        "--merge",
+        action="store_true",
+        help="Fusionne les manifestes partiels de --outputdir et controle la couverture des codes GHT",
+    )
+    parser.add_argument(
+        "--max-entries",
+        type=positive_int,
+        help="Decoupe chaque GHT en pages chainées d'au plus MAX_ENTRIES entrées",
+    )
+    parser.add_argument(
+        "--max-bytes",
+        type=positive_int,
+        help="Decoupe chaque GHT en pages chainées d'au plus MAX_BYTES octets (JSON des entrées)",
+    )
+    parser.add_argument(
+        "--index",
+        action="store_true",
+        help="Ecrit aussi les ressources en NDJSON, avec un index id/finess -> fichier et position",
+    )
+    parser.add_argument(
+        "--store",
+        help="Base historique (voir history.py) a utiliser a la place des fichiers sources",
+    )
+    parser.add_argument(
+        "--as-of",
+        type=iso_date,
+        help="Date des données lues dans la base historique (AAAA-MM-JJ, defaut : aujourd'hui)",
+    )
+    parser.add_argument(
+        "--pipeline",
+        action="store_true",
+        help="Serialisation et ecriture des fichiers en parallele de la construction des bundles",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=4,
+        help="Nombre de threads d'ecriture en mode --pipeline (defaut : 4)",
+    )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=1,
+        help="Nombre de processus de lecture du fichier Finess (defaut : 1)",
+    )
+    parser.add_argument(
+        "--cache",
+        action="store_true",
+        help="Reutilise les ressources deja serialisées, identifiées par leur contenu (voir --cache-file)",
+    )
+    parser.add_argument(
+        "--cache-file",
+        help="Fichier de conservation du cache des ressources serialisées entre deux executions",
+    )
     args = parser.parse_args()
+    if args.shard and not args.code:
+        parser.error("--shard necessite --code")
 
     ght = GHT()
-    ght.load_data(args.dgosfile, args.finessfile)
+    store = None
+    if args.store:
+        # import local : history depend de generator
+        import history
+
+        if not args.as_of:
+            args.as_of = datetime.date.today().isoformat()
+        store = history.HistoryStore(args.store)
+        store.load_ght(ght, args.as_of)
+        if ght.df_ght.empty:
+            print(f"Aucune liste GHT au {args.as_of} dans {args.store}")
+    else:
+        ght.load_ght(args.dgosfile)
+
+    # Fusion des manifestes des lots
+    if args.merge:
+        errors = merge_manifests(args.outputdir, ght.ght_codes())
+        for error in errors:
+            print(error)
+        if errors:
+            sys.exit(1)
+        print(f"Couverture complete : {len(ght.ght_codes())} codes GHT")
+        return
 
     # Liste les codes GHT disponibles
     if args.list:
@@ -661,16 +1784,75 @@ def main():
             else:
                 codes.append(args.code)
 
+        if args.shard:
+            codes = ght.shard_codes(codes, *args.shard)
+
+        # un lot ne charge que les finess de ses propres GHT
+        ej_filter = None
+        if args.prefilter or args.shard:
+            ej_filter = ght.ej_numbers(codes)
+        if store:
+            store.load_finess(ght, args.as_of, ej_filter)
+        else:
+            ght.load_finess(args.finessfile, ej_filter, jobs=args.jobs)
+
+        paginate = args.max_entries or args.max_bytes
+        files = []
+        records = []
+        cache = None
+        if args.cache or args.cache_file:
+            cache = FragmentCache(args.cache_file)
+
+        writer = None
+        if args.pipeline:
+            writer = PipelineWriter(
+                ght, args.outputdir, index=args.index, workers=args.workers, cache=cache
+            )
+
         for ght_code in codes:
             print(f"Generation GHT {ght_code}")
-            orgs = ght.make_ght_bundle(ght_code)
-            orgs_xml = ght.toxml(orgs)
+            if paginate:
+                # pages construites et ecrites une a une : {code}-1, {code}-2, ...
+                bundles = ght.make_ght_pages(
+                    ght_code, max_entries=args.max_entries, max_bytes=args.max_bytes
+                )
+            else:
+                bundles = [ght.make_ght_bundle(ght_code)]
 
-            with open(os.path.join(args.outputdir, f"{ght_code}.json"), "w") as fout:
-                fout.write(json.dumps(orgs, indent=2))
+            for page_num, orgs in enumerate(bundles, 1):
+                name = f"{ght_code}-{page_num}" if paginate else ght_code
+                if writer:
+                    writer.submit(name, ght_code, orgs)
+                    continue
 
-            with open(os.path.join(args.outputdir, f"{ght_code}.xml"), "w") as fout:
-                fout.write(xml2text(orgs_xml))
+                outputs, page_records = serialize_bundle(
+                    ght, name, ght_code, orgs, index=args.index, cache=cache
+                )
+                for filename, data in outputs:
+                    atomic_write(os.path.join(args.outputdir, filename), data)
+                    files.append(filename)
+                records.extend(page_records)
+
+        if writer:
+            files, records = writer.close()
+            for line in writer.report():
+                print(line)
+
+        if cache:
+            cache.save()
+            for line in cache.report():
+                print(line)
+
+        if args.index:
+            index_name = "index.ndjson"
+            if args.shard:
+                index_name = "index-%s-%s.ndjson" % args.shard
+            print(f"Index {write_index(os.path.join(args.outputdir, index_name), records)}")
+
+        if args.shard:
+            print(
+                f"Manifeste {write_manifest(args.outputdir, args.shard, codes, files)}"
+            )
 
 
 if __name__ == "__main__":
@@ -0,0 +1,432 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+    Base historique des fichiers sources
+
+    Chaque extraction finess (etalab-cs1100507-stock-*) et chaque liste DGOS est chargée
+    une seule fois dans une base SQLite. Seules les versions modifiées d'un établissement
+    ou d'une géolocalisation sont conservées, avec leur intervalle de validité
+    [valid_from, valid_to[ :
+
+    - valid_from : date de mise à jour (datemaj) si elle est postérieure à l'extraction
+      précédente, sinon date de l'extraction
+    - valid_to : début de la version suivante, ou date de l'extraction dans laquelle
+      l'enregistrement a disparu
+
+    L'ordre des lignes de chaque extraction est conservé dans une table {table}_order :
+    les données a une date sont restituées dans l'ordre de la derniere extraction
+    antérieure ou égale a cette date.
+
+    Les extractions doivent être chargées dans l'ordre chronologique.
+    La génération à une date donnée se fait ensuite par : python generator.py --store BASE --as-of DATE
+
+"""
+
+__author__ = "Frederic Laurent"
+__version__ = "1.0"
+__copyright__ = "Copyright 2018, Frederic Laurent"
+__license__ = "MIT"
+
+import argparse
+import codecs
+import os.path
+import re
+import sqlite3
+import sys
+
+import numpy as np
+import pandas
+
+from generator import GHT, iso_date
+
+
+def snapshot_date(filename):
+    """
+        Date d'une extraction finess : issue du nom du fichier
+        (etalab-cs1100507-stock-20181011-0450.csv), sinon de la 1ere ligne du fichier
+    :param filename: fichier etalab
+    :return: date AAAA-MM-JJ
+    """
+    res = re.search(r"-(\d{4})(\d{2})(\d{2})-", os.path.basename(filename))
+    if res:
+        return "-".join(res.groups())
+
+    with codecs.open(filename, "r", "iso-8859-1") as fin:
+        return iso_date(fin.readline().strip().split(";")[-1])
+
+
+def with_nan(df):
+    """
+        Les valeurs NULL de la base sont lues comme None : remplacement par NaN,
+        comme lors de la lecture des fichiers
+    :param df: dataframe lu dans la base
+    :return: dataframe
+    """
+    return df.where(df.notna(), np.nan)
+
+
+class HistoryStore:
+    TABLE_KEYS = {
+        "ght": ["row"] + GHT.GHT_KEYS,
+        "structureet": GHT.FINESS_KEYS,
+        "geolocalisation": GHT.GEOFINESS_KEYS,
+    }
+
+    def __init__(self, filename):
+        self.db = sqlite3.connect(filename)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS snapshots (kind TEXT, filename TEXT, date TEXT)"
+        )
+
+    def create_table(self, table, df, constraint=None):
+        """
+            Création d'une table a partir des colonnes d'un dataframe (types déduits
+            comme le fait pandas.to_sql)
+        :param table: nom de la table
+        :param df: dataframe a inserer
+        :param constraint: contrainte de table optionnelle
+        :return: -
+        """
+        columns = []
+        for name, dtype in df.dtypes.items():
+            if dtype.kind == "f":
+                columns.append(f'"{name}" REAL')
+            elif dtype.kind in "iu":
+                columns.append(f'"{name}" INTEGER')
+            else:
+                columns.append(f'"{name}" TEXT')
+        if constraint:
+            columns.append(constraint)
+        self.db.execute(f"CREATE TABLE IF NOT EXISTS {table} ({', '.join(columns)})")
+
+    def insert(self, table, df):
+        """
+            Insertion des lignes d'un dataframe, les NaN étant stockés comme NULL
+        :param table: nom de la table
+        :param df: dataframe
+        :return: -
+        """
+        columns = ", ".join(f'"{name}"' for name in df.columns)
+        marks = ", ".join("?" * len(df.columns))
+        values = df.astype(object).where(df.notna(), None).values.tolist()
+        self.db.executemany(
+            f"INSERT INTO {table} ({columns}) VALUES ({marks})", values
+        )
+
+    def has_table(self, table):
+        return (
+            self.db.execute(
+                "SELECT 1 FROM sqlite_master WHERE type='table' AND name=?", (table,)
+            ).fetchone()
+            is not None
+        )
+
+    def last_date(self, kind):
+        """
+            Date de la derniere extraction chargée
+        :param kind: finess ou dgos
+        :return: date AAAA-MM-JJ ou None
+        """
+        return self.db.execute(
+            "SELECT MAX(date) FROM snapshots WHERE kind=?", (kind,)
+        ).fetchone()[0]
+
+    def ingest_finess(self, filename, date=None):
+        """
+            Chargement d'une extraction finess
+        :param filename: fichier etalab
+        :param date: date de l'extraction, deduite du fichier si absente
+        :return: -
+        """
+        date = date or snapshot_date(filename)
+        last = self.last_date("finess")
+        if last and date <= last:
+            print(f"{filename} ({date}) ignoré : extraction du {last} deja chargée")
+            return
+
+        ght = GHT()
+        ght.load_finess(filename)
+        # une extraction est chargée dans une seule transaction : une interruption
+        # ne laisse aucune version ni aucun ordre partiel dans la base
+        with self.db:
+            self.db.execute("BEGIN")
+            for table, df in (
+                ("structureet", ght.df_finess),
+                ("geolocalisation", ght.df_finess_geo),
+            ):
+                added, changed, closed = self.ingest_table(table, df, date, last)
+                print(
+                    f"{filename} ({date}) {table} : {added} ajouts, {changed} modifications, {closed} suppressions"
+                )
+
+            self.db.execute(
+                "INSERT INTO snapshots VALUES (?, ?, ?)", ("finess", filename, date)
+            )
+
+    def ingest_table(self, table, df, date, last):
+        """
+            Ajout des versions nouvelles ou modifiées d'une table, cloture des versions remplacées
+        :param table: structureet ou geolocalisation
+        :param df: contenu de l'extraction
+        :param date: date de l'extraction
+        :param last: date de l'extraction précédente
+        :return: nombre d'ajouts, de modifications, de suppressions
+        """
+        keys = HistoryStore.TABLE_KEYS[table]
+        df = df[keys].drop_duplicates(subset="nofinesset").copy()
+        df["position"] = range(len(df))
+        df["digest"] = pandas.util.hash_pandas_object(df[keys], index=False).astype(str)
+
+        if self.has_table(table):
+            current = pandas.read_sql(
+                f"SELECT nofinesset, digest AS digest_prev FROM {table} WHERE valid_to IS NULL",
+                self.db,
+            )
+        else:
+            current = pandas.DataFrame(columns=["nofinesset", "digest_prev"])
+
+        merged = df.merge(current, on="nofinesset", how="left")
+        new_versions = merged[merged.digest != merged.digest_prev].copy()
+
+        # debut de validite : datemaj si elle tombe entre les deux extractions
+        datemaj = new_versions.datemaj.fillna("")
+        in_range = (datemaj > (last or date)) & (datemaj <= date)
+        new_versions["valid_from"] = new_versions.datemaj.where(in_range, date)
+        new_versions["valid_to"] = None
+
+        changed = new_versions[new_versions.digest_prev.notna()]
+        removed = current[~current.nofinesset.isin(df.nofinesset)]
+
+        if len(current):
+            self.db.executemany(
+                f"UPDATE {table} SET valid_to=? WHERE nofinesset=? AND valid_to IS NULL",
+                list(zip(changed.valid_from, changed.nofinesset))
+                + [(date, et) for et in removed.nofinesset],
+            )
+        new_versions = new_versions.drop(columns=["digest_prev"])
+        self.create_table(table, new_versions)
+        self.insert(table, new_versions)
+        # ordre des lignes de l'extraction, conservé a part des versions
+        order = df[["nofinesset", "position"]].assign(snapshot=date)
+        self.create_table(f"{table}_order", order, "UNIQUE (snapshot, nofinesset)")
+        self.insert(f"{table}_order", order)
+        self.db.execute(
+            f"CREATE INDEX IF NOT EXISTS {table}_order_snapshot ON {table}_order (snapshot, nofinesset)"
+        )
+        self.db.execute(
+            f"CREATE INDEX IF NOT EXISTS {table}_validity ON {table} (valid_from, valid_to)"
+        )
+        self.db.execute(
+            f"CREATE INDEX IF NOT EXISTS {table}_current ON {table} (nofinesset, valid_to)"
+        )
+        return len(new_versions) - len(changed), len(changed), len(removed)
+
+    def ingest_dgos(self, filename, date):
+        """
+            Chargement d'une liste DGOS. La liste n'est conservée que si elle differe de la précédente.
+        :param filename: fichier du ministère
+        :param date: date de publication de la liste
+        :return: -
+        """
+        last = self.last_date("dgos")
+        if last and date <= last:
+            print(f"{filename} ({date}) ignoré : liste du {last} deja chargée")
+            return
+
+        ght = GHT()
+        ght.load_ght(filename)
+        df = ght.df_ght[GHT.GHT_KEYS].copy()
+        df.insert(0, "row", df.index)
+
+        with self.db:
+            self.db.execute("BEGIN")
+            if self.has_table("ght"):
+                current = pandas.read_sql(
+                    "SELECT * FROM ght WHERE valid_to IS NULL ORDER BY row", self.db
+                )
+                current = with_nan(current[df.columns])
+                unchanged = current.equals(df.reset_index(drop=True))
+                if unchanged:
+                    print(f"{filename} ({date}) : liste GHT inchangée")
+                else:
+                    self.db.execute(
+                        "UPDATE ght SET valid_to=? WHERE valid_to IS NULL", (date,)
+                    )
+            else:
+                unchanged = False
+
+            if not unchanged:
+                df["valid_from"] = date
+                df["valid_to"] = None
+                self.create_table("ght", df)
+                self.insert("ght", df)
+                print(f"{filename} ({date}) : {len(df)} établissements GHT")
+
+            self.db.execute(
+                "INSERT INTO snapshots VALUES (?, ?, ?)",
+                ("dgos", filename, date),
+            )
+
+    def read_as_of(self, table, date, order):
+        if not self.has_table(table):
+            return pandas.DataFrame(columns=HistoryStore.TABLE_KEYS[table])
+        return with_nan(
+            pandas.read_sql(
+                f"SELECT * FROM {table} WHERE valid_from <= ? AND (valid_to IS NULL OR valid_to > ?) ORDER BY {order}",
+                self.db,
+                params=(date, date),
+            )
+        )
+
+    def finess_snapshot(self, date):
+        """
+            Derniere extraction finess antérieure ou égale a une date
+        :param date: date AAAA-MM-JJ
+        :return: date de l'extraction ou None
+        """
+        return self.db.execute(
+            "SELECT MAX(date) FROM snapshots WHERE kind='finess' AND date <= ?", (date,)
+        ).fetchone()[0]
+
+    def read_finess_as_of(self, table, date):
+        """
+            Lignes d'une table finess valides a la date donnée, dans l'ordre de la derniere
+            extraction antérieure ou égale a cette date (les lignes absentes de cette
+            extraction suivent, dans l'ordre de l'extraction qui les a introduites)
+
+        :param table: structureet ou geolocalisation
+        :param date: date AAAA-MM-JJ
+        :return: dataframe
+        """
+        keys = HistoryStore.TABLE_KEYS[table]
+        if not self.has_table(table):
+            return pandas.DataFrame(columns=keys)
+
+        snapshot = self.finess_snapshot(date)
+        columns = ", ".join(f"t.{key}" for key in keys)
+        return with_nan(
+            pandas.read_sql(
+                f"SELECT {columns} FROM {table} t "
+                f"LEFT JOIN {table}_order o ON o.snapshot = ? AND o.nofinesset = t.nofinesset "
+                "WHERE t.valid_from <= ? AND (t.valid_to IS NULL OR t.valid_to > ?) "
+                "ORDER BY o.position IS NULL, o.position, t.position",
+                self.db,
+                params=(snapshot, date, date),
+            )
+        )
+
+    def load_ght(self, ght, date):
+        """
+            Liste des GHT valide a la date donnée
+        :param ght: objet GHT a alimenter
+        :param date: date AAAA-MM-JJ
+        :return: -
+        """
+        df = self.read_as_of("ght", date, "row")
+        df = df.set_index("row")[GHT.GHT_KEYS]
+        df.index.name = None
+        ght.df_ght = df
+
+    def load_finess(self, ght, date, ej_filter=None):
+        """
+            Etablissements et géolocalisations valides a la date donnée
+        :param ght: objet GHT a alimenter
+        :param date: date AAAA-MM-JJ
+        :param ej_filter: ensemble des finess EJ a conserver, tous si None
+        :return: -
+        """
+        if self.finess_snapshot(date) is None:
+            print(
+                f"Attention : aucune extraction finess au {date} ou avant, "
+                "seules les entités juridiques de la liste GHT seront produites"
+            )
+        df = self.read_finess_as_of("structureet", date)
+        df_geo = self.read_finess_as_of("geolocalisation", date)
+        if ej_filter is not None:
+            df = df[df.nofinessej.isin(ej_filter)]
+            df_geo = df_geo[df_geo.nofinesset.isin(df.nofinesset)]
+
+        ght.df_finess = df.reset_index(drop=True)
+        ght.df_finess_geo = df_geo.reset_index(drop=True)
+        ght.prepare_finess()
+
+    def check(self):
+        """
+            Controle de la base : pour chaque extraction chargée dont le fichier est
+            present, les données lues directement et celles restituées par la base
+            a la date de l'extraction doivent etre identiques (contenu et ordre)
+
+        :return: liste des extractions en erreur
+        """
+        errors = []
+        for filename, date in self.db.execute(
+            "SELECT filename, date FROM snapshots WHERE kind='finess' ORDER BY date"
+        ).fetchall():
+            if not os.path.exists(filename):
+                print(f"{filename} ({date}) : fichier absent, non controlé")
+                continue
+
+            direct = GHT()
+            direct.load_finess(filename)
+            stored = GHT()
+            self.load_finess(stored, date)
+
+            same = all(
+                df_direct[keys].astype(str).values.tolist()
+                == df_stored[keys].astype(str).values.tolist()
+                for df_direct, df_stored, keys in (
+                    (direct.df_finess, stored.df_finess, GHT.FINESS_KEYS),
+                    (direct.df_finess_geo, stored.df_finess_geo, GHT.GEOFINESS_KEYS),
+                )
+            )
+            print(f"{filename} ({date}) : {'OK' if same else 'KO'}")
+            if not same:
+                errors.append(filename)
+        return errors
+
+
+def main():
+    """
+        Programme principal
+
+        - parse les arguments
+        - charge les extractions dans la base historique
+    """
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--store", help="Base historique", required=True)
+    parser.add_argument(
+        "--finessfile",
+        nargs="+",
+        default=[],
+        help="Fichiers Finess des établissements, chargés par date d'extraction",
+    )
+    parser.add_argument(
+        "--dgosfile",
+        nargs=2,
+        action="append",
+        default=[],
+        metavar=("DGOSFILE", "DATE"),
+        help="Fichier du ministère et sa date de publication (AAAA-MM-JJ)",
+    )
+    parser.add_argument(
+        "--check",
+        action="store_true",
+        help="Compare chaque extraction chargée aux données restituées par la base a sa date",
+    )
+    args = parser.parse_args()
+
+    store = HistoryStore(args.store)
+
+    for filename, date in sorted(args.dgosfile, key=lambda x: x[1]):
+        store.ingest_dgos(filename, iso_date(date))
+
+    for filename in sorted(args.finessfile, key=snapshot_date):
+        store.ingest_finess(filename)
+
+    if args.check and store.check():
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()